@@ -18,10 +18,22 @@
 // Maven doesn't seem to have any way to just dump all resolved dependencies in
 // a structured data format, so we manually resolve things and then grep the
 // log file for all downloaded artifacts.
+//
+// The dependency plugin comes close but doesn't cut it: dependency:list only
+// writes coordinates, not the repository each artifact came from, and omits
+// POMs, parent POMs and metadata, which the offline build needs as well.
+// dependency:go-offline misses plugins and dependencies which are only
+// resolved in the middle of the build.  Running the actual build is the only
+// reliable way to get the complete set.
 
 import * as path from "jsr:@std/path@1";
 import * as yaml from "jsr:@std/yaml@1";
 import * as fs from "jsr:@std/fs@1";
+import { crypto } from "jsr:@std/crypto@1";
+import { pooledMap } from "jsr:@std/async@1";
+import { TextLineStream } from "jsr:@std/streams@1";
+import { escape } from "jsr:@std/regexp@1";
+import { parseArgs } from "jsr:@std/cli@1/parse-args";
 
 type SourceType = "archive" | "file" | "patch";
 
@@ -34,7 +46,7 @@ interface FileSource {
 interface UrlSource {
     readonly type: SourceType;
     readonly url: string;
-    readonly sha512: string;
+    readonly sha256: string;
     readonly dest?: string;
     readonly "dest-filename"?: string;
 }
@@ -71,6 +83,52 @@ const checkedRun = async (
     return output;
 };
 
+/**
+ * Run a command and iterate over the lines of its standard output.
+ *
+ * Stream the output instead of buffering it, so that even a large output
+ * never needs to be held in memory as a whole.  If the command returns a
+ * non-zero exit code, throw an error after all output was consumed.  If
+ * iteration stops early, kill the command and wait for it to exit.
+ *
+ * @param command The command to run
+ * @param options Additional options for the command
+ * @returns The lines of standard output of the command
+ */
+async function* checkedRunLines(
+    command: readonly string[],
+    options?: Deno.CommandOptions,
+): AsyncGenerator<string> {
+    const child = new Deno.Command(command[0], {
+        args: command.slice(1),
+        ...options,
+        stdout: "piped",
+    }).spawn();
+    let consumed = false;
+    try {
+        yield* child.stdout
+            .pipeThrough(new TextDecoderStream())
+            .pipeThrough(new TextLineStream());
+        consumed = true;
+    } finally {
+        if (!consumed) {
+            try {
+                child.kill();
+            } catch (error) {
+                // The command already exited on its own
+                if (!(error instanceof TypeError)) {
+                    throw error;
+                }
+            }
+            await child.status;
+        }
+    }
+    const status = await child.status;
+    if (!status.success) {
+        throw new Error(`Failed to run command ${command.join(" ")}`);
+    }
+}
+
 /**
  * Determine whether the given flatpak module source refers to Git.
  *
@@ -109,9 +167,9 @@ const getMainSource = async (manifestDirectory: string): Promise<GitSource> => {
     if (!module) {
         throw new Error("Failed to find mediathekview module");
     }
-    const source = module.sources
-        .filter(isGitSource)
-        .find((source) => source.url.includes("mediathekview"));
+    const source = module.sources.find((source): source is GitSource =>
+        isGitSource(source) && source.url.includes("mediathekview")
+    );
     if (!source) {
         throw new Error("No archive source found for MediathekView");
     }
@@ -119,14 +177,29 @@ const getMainSource = async (manifestDirectory: string): Promise<GitSource> => {
 };
 
 /**
- * Calculate the SHA512 digest of a file.
+ * Size in bytes above which files are digested as a stream.
+ */
+const STREAMING_DIGEST_THRESHOLD = 16 * 1024 * 1024;
+
+/**
+ * Calculate the SHA256 digest of a file.
  *
  * @param file The file to compute the checksum of
- * @returns The sha512 digest as hexadecimal string
+ * @returns The sha256 digest as hexadecimal string
  */
-const sha512sum = async (file: string): Promise<string> => {
-    const digest = await crypto.subtle
-        .digest("SHA-512", await Deno.readFile(file));
+const sha256sum = async (file: string): Promise<string> => {
+    // Digest small files in one go, which lets WebCrypto hash them natively
+    // and off the main thread.  Stream larger files into the digest instead of
+    // reading them into memory as a whole.
+    const { size } = await Deno.stat(file);
+    let digest: ArrayBuffer;
+    if (size <= STREAMING_DIGEST_THRESHOLD) {
+        digest = await crypto.subtle
+            .digest("SHA-256", await Deno.readFile(file));
+    } else {
+        using handle = await Deno.open(file);
+        digest = await crypto.subtle.digest("SHA-256", handle.readable);
+    }
     return Array.from(new Uint8Array(digest))
         .map((b) => b.toString(16).padStart(2, "0"))
         .join("");
@@ -145,85 +218,191 @@ interface ArtifactURL {
      * The URL path relative to `repoBaseUrl`.
      */
     readonly relpath: string;
+    /**
+     * The ID of the repository the artifact was downloaded from.
+     */
+    readonly repoId: string;
 }
 
 /**
  * Known base URLs of Maven repositories.
  */
-const REPO_BASES = [
+const REPO_BASES: readonly string[] = [
     "https://repo.maven.apache.org/maven2/",
     "https://oss.sonatype.org/content/repositories/snapshots/",
     "https://maven.ej-technologies.com/repository/",
 ];
 
+/**
+ * Matches any of the known repository base URLs at the start of a URL.
+ *
+ * Alternatives are tried in order, so put longer bases first, to match the
+ * most specific base if one base is a prefix of another.
+ */
+const REPO_BASE_RE = new RegExp(
+    `^(?:${
+        REPO_BASES.toSorted((a, b) => b.length - a.length)
+            .map(escape)
+            .join("|")
+    })`,
+);
+
 /**
  * Parse a URL point to an artifact in a maven repository.
  *
  * @param url The URL of an artifact.
+ * @param repoId The ID of the repository the artifact was downloaded from.
  * @returns The parsed URL.
  */
-const parseUrl = (url: string): ArtifactURL => {
-    for (const base of REPO_BASES) {
-        if (url.startsWith(base)) {
-            return {
-                url,
-                repoBaseUrl: base,
-                relpath: url.slice(base.length),
-            };
-        }
+const parseUrl = (url: string, repoId: string): ArtifactURL => {
+    const match = REPO_BASE_RE.exec(url);
+    if (!match) {
+        throw new Error(`Failed to determine repository base of ${url}`);
     }
-    throw new Error(`Failed to determine repository base of ${url}`);
+    const base = match[0];
+    return {
+        url,
+        repoBaseUrl: base,
+        relpath: url.slice(base.length),
+        repoId,
+    };
 };
 
+/**
+ * Matches a downloaded artifact in the Maven build log.
+ *
+ * The first group is the ID of the repository, the second group the URL of
+ * the artifact.
+ */
+const DOWNLOADED_RE = /Downloaded from ([^:]+): (https?:\/\/\S+)/;
+
 /**
  * Extracts all downloaded artifacts from a build log of a Maven build.
  *
- * @param mavenOutput The full output of a Maven build
- * @returns A list of all artifacts that were downloaded during thebuild.
+ * The same artifact may be reported more than once, e.g. if multiple modules
+ * depend on it; only yield the first occurrence of each artifact.
+ *
+ * @param mavenOutput The lines of the output of a Maven build
+ * @returns All artifacts that were downloaded during the build.
  */
-const extractDownloadedArtifacts = (mavenOutput: string): ArtifactURL[] => {
-    const urls = [];
-    for (const line of mavenOutput.split("\n")) {
-        const match = line.match(/Downloaded from .*: (https?:\/\/[^ ]+)/);
-        if (!match) {
-            continue;
+async function* extractDownloadedArtifacts(
+    mavenOutput: AsyncIterable<string>,
+): AsyncGenerator<ArtifactURL> {
+    const seen = new Set<string>();
+    for await (const line of mavenOutput) {
+        const match = DOWNLOADED_RE.exec(line);
+        if (match && !seen.has(match[2])) {
+            seen.add(match[2]);
+            yield parseUrl(match[2], match[1]);
         }
-        urls.push(parseUrl(match[1]));
     }
-    return urls;
+}
+
+/**
+ * Read the digests of artifacts from a previously generated dependency list.
+ *
+ * @param file The previous dependency list, e.g. `maven-dependencies.json`
+ * @returns The sha256 digests of all artifacts in `file`, by artifact URL
+ */
+const readKnownDigests = async (
+    file: string,
+): Promise<Map<string, string>> => {
+    let sources: readonly { url?: string; sha256?: string }[];
+    try {
+        sources = JSON.parse(await Deno.readTextFile(file));
+    } catch (error) {
+        if (error instanceof Deno.errors.NotFound) {
+            return new Map();
+        }
+        throw error;
+    }
+    return new Map(
+        sources.flatMap(({ url, sha256 }) =>
+            url && sha256 ? [[url, sha256] as const] : []
+        ),
+    );
 };
 
+/**
+ * The location of the local Maven repository in the flatpak build directory.
+ */
+const M2_REPOSITORY = ".m2/repository";
+
 /**
  * Create a flatpak source object from an artifact URL.
  *
- * Calculate the SHA 512 checksum of the artifact, and define a file structure
+ * Calculate the SHA 256 checksum of the artifact, and define a file structure
  * to reconstruct its place in a maven repository.
  *
+ * Reuse the known digest of released artifacts instead of calculating it
+ * again.
+ *
  * @param repoDirectory The repository directory
+ * @param knownDigests Known sha256 digests of artifacts, by URL
  * @param url The artifact URL
  * @returns A corresponding flatpak URL
  */
 const artifactUrlToFlatpakSource = async (
     repoDirectory: string,
+    knownDigests: ReadonlyMap<string, string>,
     url: ArtifactURL,
 ): Promise<UrlSource> => {
-    const dest = path.dirname(path.join(".m2/repository", url.relpath));
-    let destname = path.basename(url.relpath);
-    const dir = path.dirname(path.join(repoDirectory, url.relpath));
-    if (destname === "maven-metadata.xml") {
-        const candidates = fs.expandGlob(path.join(dir, "maven-metadata*.xml"));
-        for await (const entry of candidates) {
-            destname = entry.name;
-        }
-    }
-    const sha512 = await sha512sum(path.join(dir, destname));
+    // relpath is a URL path, so split it into directory and file name once,
+    // and derive the destination and local directory from these.
+    const separator = url.relpath.lastIndexOf("/");
+    const reldir = separator === -1 ? "" : url.relpath.slice(0, separator);
+    const filename = url.relpath.slice(separator + 1);
+    const dest = reldir ? `${M2_REPOSITORY}/${reldir}` : M2_REPOSITORY;
+    const dir = path.join(repoDirectory, reldir);
+    // Metadata and snapshots change over time, even under the same URL.
+    const mutable = filename === "maven-metadata.xml" ||
+        reldir.endsWith("-SNAPSHOT");
+    // Maven stores downloaded metadata under a name qualified with the
+    // repository ID, e.g. maven-metadata-central.xml.
+    const destname = filename === "maven-metadata.xml"
+        ? `maven-metadata-${url.repoId}.xml`
+        : filename;
+    const sha256 = (!mutable && knownDigests.get(url.url)) ||
+        await sha256sum(path.join(dir, destname));
     return {
         type: "file",
         url: url.url,
         dest,
         "dest-filename": destname,
-        sha512,
+        sha256,
+    };
+};
+
+/**
+ * Map over an async iterable with a limited number of concurrent calls.
+ *
+ * Like `pooledMap`, but rethrow an error thrown by `iterable` itself as is;
+ * `pooledMap` swallows it and rejects with an empty `AggregateError` instead.
+ *
+ * @param poolLimit The maximum number of concurrent calls to `fn`
+ * @param iterable The items to map over
+ * @param fn The function to apply to each item
+ * @returns The results of `fn`, in the order of `iterable`
+ */
+const pooledMapAll = async <T, R>(
+    poolLimit: number,
+    iterable: AsyncIterable<T>,
+    fn: (item: T) => Promise<R>,
+): Promise<R[]> => {
+    let iterableError: { readonly error: unknown } | undefined;
+    const guarded = async function* () {
+        try {
+            yield* iterable;
+        } catch (error) {
+            iterableError = { error };
+            throw error;
+        }
     };
+    try {
+        return await Array.fromAsync(pooledMap(poolLimit, guarded(), fn));
+    } catch (error) {
+        throw iterableError ? iterableError.error : error;
+    }
 };
 
 /**
@@ -252,12 +431,20 @@ const withTempDir = async <T>(
     }
 };
 
-const main = () =>
+const main = (args: string[]) =>
     withTempDir(async (workingDirectory) => {
+        const flags = parseArgs(args, { boolean: ["recompute-hashes"] });
         const manifestDirectory = import.meta.dirname;
         if (!manifestDirectory) {
             throw new Error("Not running as local module?");
         }
+        const dependenciesFile = path.join(
+            manifestDirectory,
+            "maven-dependencies.json",
+        );
+        const knownDigests = flags["recompute-hashes"]
+            ? new Map<string, string>()
+            : await readKnownDigests(dependenciesFile);
 
         const source = await getMainSource(manifestDirectory);
         const repoDirectory = path.join(workingDirectory, "repo");
@@ -277,7 +464,7 @@ const main = () =>
         });
 
         // TODO: Do we need to run a full "install"?
-        const output = (await checkedRun(
+        const output = checkedRunLines(
             [
                 path.join(sourceDirectory, "mvnw"),
                 // Enable batch mode for non-interactive builds, which
@@ -290,25 +477,28 @@ const main = () =>
                 "clean",
                 "install",
             ],
-            {
-                cwd: sourceDirectory,
-                stdout: "piped",
-            },
-        )).stdout;
+            { cwd: sourceDirectory },
+        );
 
-        const urls = extractDownloadedArtifacts(
-            new TextDecoder().decode(output),
+        // Hash artifacts concurrently, but limit the number of artifacts in
+        // flight to the number of CPUs, to avoid opening hundreds of files at
+        // once.  Maven only logs an artifact after it has finished downloading
+        // it, so we can hash artifacts while the build is still running.
+        const sources = await pooledMapAll(
+            navigator.hardwareConcurrency,
+            extractDownloadedArtifacts(output),
+            (u) => artifactUrlToFlatpakSource(repoDirectory, knownDigests, u),
         );
-        const sources = await Promise
-            .all(urls.map((u) => artifactUrlToFlatpakSource(repoDirectory, u)));
         const collator = Intl.Collator();
         sources.sort((a, b) => collator.compare(a.url, b.url));
-        Deno.writeTextFile(
-            path.join(manifestDirectory, "maven-dependencies.json"),
+        // Sources are plain objects already, so JSON.stringify serializes them
+        // natively without any per-object callbacks.
+        await Deno.writeTextFile(
+            dependenciesFile,
             JSON.stringify(sources, undefined, 2),
         );
     });
 
 if (import.meta.main) {
-    main();
+    main(Deno.args);
 }